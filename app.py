@@ -1,11 +1,23 @@
 import os
 import time
-import base64
+import re
 import json
+import atexit
+from itertools import count
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import pybase64 as base64  # SIMD, API sama dengan modul base64 bawaan
+except ImportError:
+    import base64
 import requests
-from flask import Flask, request, jsonify
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from flask import Flask, request, jsonify, after_this_request
 from inference_sdk import InferenceHTTPClient
-from threading import Lock
+from threading import Lock, Event, Thread
 
 app = Flask(__name__)
 
@@ -18,62 +30,420 @@ if not GITHUB_TOKEN:
     raise ValueError("GITHUB_TOKEN environment variable is required")
 
 # ================= PERSISTENT STORAGE =================
-ESP_RESULTS_FILE = "esp_results.json"
-ESP_RESULTS      = {}
-ESP_LOCK         = Lock()
+ESP_RESULTS_FILE    = "esp_results.json"
+ESP_RESULTS_LOG     = "esp_results.log"
+ESP_RESULTS_LOG_OLD = "esp_results.log.old"
+SNAPSHOT_INTERVAL   = 60
+ESP_RESULTS         = {}
+ESP_LOCK            = Lock()
 
 # ================= GITHUB CONFIG =================
-GITHUB_REPO       = "onlykartika/ESP32-CAM"
-GITHUB_FOLDER     = "images"
-GITHUB_API_ROOT   = f"https://api.github.com/repos/{GITHUB_REPO}/contents"
-GITHUB_HEADERS    = {
+GITHUB_REPO        = "onlykartika/ESP32-CAM"
+GITHUB_FOLDER      = "images"
+GITHUB_BRANCH      = os.environ.get("GITHUB_BRANCH")  # kosong = default branch repo
+GITHUB_API_REPO    = f"https://api.github.com/repos/{GITHUB_REPO}"
+GITHUB_API_ROOT    = f"{GITHUB_API_REPO}/contents"
+# URL tetap, dibangun sekali saat start
+ESP_RESULTS_URL    = f"{GITHUB_API_ROOT}/esp_results.json"
+GITHUB_BLOBS_URL   = f"{GITHUB_API_REPO}/git/blobs"
+GITHUB_TREES_URL   = f"{GITHUB_API_REPO}/git/trees"
+GITHUB_COMMITS_URL = f"{GITHUB_API_REPO}/git/commits"
+GITHUB_HEADERS     = {
     "Authorization": f"token {GITHUB_TOKEN}",
     "User-Agent":    "Render-AI-Server",
     "Accept":        "application/vnd.github.v3+json"
 }
 
+# (connect, read): handshake lambat gagal cepat, tidak memakan jatah baca
+GITHUB_READ_TIMEOUT  = (3.05, 10)
+GITHUB_WRITE_TIMEOUT = (3.05, 15)
+
+# Satu session untuk semua call GitHub — koneksi TLS dipakai ulang (keep-alive)
+GH_SESSION = requests.Session()
+GH_SESSION.headers.update(GITHUB_HEADERS)
+GH_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+))
+
+# ================= JSON =================
+# orjson (Rust) kalau ada, fallback ke json bawaan. Keduanya return bytes.
+def json_dumps(obj, indent=False, default=None):
+    if orjson is not None:
+        return orjson.dumps(obj, default=default, option=orjson.OPT_INDENT_2 if indent else None)
+    return json.dumps(obj, indent=2 if indent else None, default=default).encode()
+
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+# ================= GITHUB HELPERS =================
+def github_get_json(url):
+    """Return body JSON, atau None kalau bukan 200."""
+    res = GH_SESSION.get(url, timeout=GITHUB_READ_TIMEOUT)
+    return res.json() if res.status_code == 200 else None
+
+class GitHubError(Exception):
+    def __init__(self, url, res):
+        super().__init__(f"{url} {res.status_code}: {res.text[:200]}")
+        self.status_code = res.status_code
+
+def _is_rejected(err):
+    """
+    400/422: isi request-nya yang salah, percuma diulang. Status lain
+    (404 token tidak bisa lihat repo, 401/403 auth / rate limit, 5xx)
+    dianggap sementara.
+    """
+    return isinstance(err, GitHubError) and err.status_code in (400, 422)
+
+def _github_post(url, payload):
+    res = GH_SESSION.post(url, json=payload, timeout=GITHUB_WRITE_TIMEOUT)
+    if res.status_code != 201:
+        raise GitHubError(url, res)
+    return res.json()
+
+# ================= GITHUB BATCH COMMIT =================
+# /upload tidak bicara ke GitHub. Gambar masuk _PENDING_IMAGES dan
+# ESP_RESULTS ditandai dirty; _github_flusher lalu membuat SATU commit lewat
+# Git Data API (blob gambar -> tree -> commit -> update ref) paling sering
+# sekali per GITHUB_FLUSH_INTERVAL detik, berisi semua gambar yang antre
+# plus esp_results.json terbaru.
+GITHUB_FLUSH_INTERVAL = 5
+MAX_PENDING_IMAGES    = 200
+IMAGE_SAMPLE_EVERY    = max(1, int(os.environ.get("IMAGE_SAMPLE_EVERY", 10)))
+_EMPTY_FRAMES         = {}    # esp_id -> itertools.count() frame kosong, untuk sampling
+_GITHUB_DIRTY         = Event()
+_RESULTS_READY        = Event()  # ESP_RESULTS sudah lengkap (lokal / hasil GitHub)
+_GITHUB_FLUSH_LOCK    = Lock()
+GITHUB_MAX_BACKOFF    = 300
+_PENDING_IMAGES       = {}    # path di repo -> {"b64": jpeg base64, "sha": blob sha / None}
+_PENDING_LOCK         = Lock()
+_GH_HEAD              = None  # (commit sha, tree sha) dari commit terakhir kita
+
+# X-ESP-ID dari client dipakai sebagai path di repo: buang "/", ".." dsb.
+_UNSAFE_ID_CHARS   = re.compile(r"[^A-Za-z0-9_-]")
+_UNSAFE_FILE_CHARS = re.compile(r"[^A-Za-z0-9_.-]")
+
+def _esp_folder(esp_id):
+    folder_id = esp_id.split('_')[-1] if '_' in esp_id else esp_id
+    return f"{GITHUB_FOLDER}/esp_{_UNSAFE_ID_CHARS.sub('_', folder_id)}"
+
+def queue_image(esp_id, filename, img_b64):
+    filename = _UNSAFE_FILE_CHARS.sub("_", filename)
+    with _PENDING_LOCK:
+        if len(_PENDING_IMAGES) >= MAX_PENDING_IMAGES:
+            dropped = next(iter(_PENDING_IMAGES))
+            del _PENDING_IMAGES[dropped]
+            print(f"[WARN] GitHub queue penuh, buang {dropped}")
+        _PENDING_IMAGES[f"{_esp_folder(esp_id)}/{filename}"] = {"b64": img_b64, "sha": None}
+    _GITHUB_DIRTY.set()
+
+def _requeue_images(images):
+    """Kembalikan gambar yang gagal ke DEPAN antrean, lalu buang yang paling lama."""
+    with _PENDING_LOCK:
+        merged = dict(images)
+        merged.update(_PENDING_IMAGES)
+        _PENDING_IMAGES.clear()
+        _PENDING_IMAGES.update(merged)
+        dropped = 0
+        while len(_PENDING_IMAGES) > MAX_PENDING_IMAGES:
+            del _PENDING_IMAGES[next(iter(_PENDING_IMAGES))]
+            dropped += 1
+    if dropped:
+        print(f"[WARN] GitHub queue penuh, buang {dropped} gambar terlama")
+
+def _github_branch():
+    """Branch tujuan: GITHUB_BRANCH dari env, atau default branch repo (diambil sekali)."""
+    global GITHUB_BRANCH
+    if not GITHUB_BRANCH:
+        repo = github_get_json(GITHUB_API_REPO)
+        if repo is None:
+            raise Exception(f"gagal membaca default branch {GITHUB_REPO}")
+        GITHUB_BRANCH = repo["default_branch"]
+        print(f"[INFO] GitHub branch: {GITHUB_BRANCH}")
+    return GITHUB_BRANCH
+
+def _github_head():
+    branch = _github_branch()
+    ref    = github_get_json(f"{GITHUB_API_REPO}/git/ref/heads/{branch}")
+    if ref is None:
+        raise Exception(f"branch {branch} tidak ditemukan")
+    commit_sha = ref["object"]["sha"]
+    commit     = github_get_json(f"{GITHUB_COMMITS_URL}/{commit_sha}")
+    return commit_sha, commit["tree"]["sha"]
+
+def _github_commit(tree_entries, message):
+    """Commit di atas head terakhir; kalau branch sudah maju (422), ambil head baru sekali."""
+    global _GH_HEAD
+    for attempt in range(2):
+        if _GH_HEAD is None or attempt:
+            _GH_HEAD = _github_head()
+        parent_sha, base_tree = _GH_HEAD
+
+        tree   = _github_post(GITHUB_TREES_URL, {"base_tree": base_tree, "tree": tree_entries})
+        commit = _github_post(GITHUB_COMMITS_URL, {
+            "message": message,
+            "tree":    tree["sha"],
+            "parents": [parent_sha]
+        })
+        res = GH_SESSION.patch(
+            f"{GITHUB_API_REPO}/git/refs/heads/{_github_branch()}",
+            json={"sha": commit["sha"]}, timeout=GITHUB_WRITE_TIMEOUT
+        )
+        if res.status_code == 200:
+            _GH_HEAD = (commit["sha"], tree["sha"])
+            return
+        if res.status_code != 422:
+            break
+    raise Exception(f"update ref {res.status_code}: {res.text[:200]}")
+
+def _flush_to_github():
+    """
+    Snapshot diambil di dalam _GITHUB_FLUSH_LOCK, jadi flush yang jalan
+    terakhir selalu membawa data terbaru. Kalau gagal, gambar dikembalikan
+    ke antrean (beserta sha blob yang sudah jadi, supaya blob tidak dibuat
+    ulang) dan flag dirty dipasang lagi. Gambar yang ditolak GitHub (4xx)
+    dibuang supaya tidak memblokir sync. Return True kalau commit berhasil.
+    """
+    with _GITHUB_FLUSH_LOCK:
+        with _PENDING_LOCK:
+            images = dict(_PENDING_IMAGES)
+            _PENDING_IMAGES.clear()
+        with ESP_LOCK:
+            snapshot = dict(ESP_RESULTS)
+
+        try:
+            results_entry = {
+                "path":    "esp_results.json",
+                "mode":    "100644",
+                "type":    "blob",
+                "content": json_dumps(snapshot).decode()
+            }
+            image_entries = []
+            for path, item in list(images.items()):
+                if item["sha"] is None:
+                    try:
+                        blob = _github_post(GITHUB_BLOBS_URL, {"content": item["b64"], "encoding": "base64"})
+                    except GitHubError as e:
+                        if not _is_rejected(e):
+                            raise
+                        del images[path]
+                        print(f"[WARN] GitHub tolak gambar {path}, dibuang: {e}")
+                        continue
+                    # Blob sudah di GitHub; base64 tidak perlu disimpan lagi
+                    images[path] = item = {"b64": None, "sha": blob["sha"]}
+                image_entries.append({"path": path, "mode": "100644", "type": "blob", "sha": item["sha"]})
+
+            message = f"Update esp_results + {len(image_entries)} image(s) - {time.strftime('%Y-%m-%d %H:%M')}"
+            try:
+                _github_commit([results_entry] + image_entries, message)
+            except GitHubError as e:
+                if not (_is_rejected(e) and image_entries):
+                    raise
+                # Tree ditolak: jangan biarkan gambar memblokir esp_results.json
+                print(f"[WARN] GitHub tolak tree, buang {len(image_entries)} gambar: {e}")
+                images, image_entries = {}, []
+                _github_commit([results_entry], f"Update esp_results - {time.strftime('%Y-%m-%d %H:%M')}")
+            print(f"[INFO] GitHub commit: esp_results.json + {len(image_entries)} image(s)")
+            return True
+        except Exception as e:
+            _requeue_images(images)
+            _GITHUB_DIRTY.set()
+            print(f"[WARN] GitHub commit error: {e}")
+            return False
+
+def _github_flusher():
+    # Jangan timpa esp_results.json di GitHub sebelum isinya selesai dimuat
+    _RESULTS_READY.wait()
+    failures = 0
+    while True:
+        _GITHUB_DIRTY.wait()
+        # Kumpulkan update yang datang berdekatan; setelah gagal, jeda
+        # naik eksponensial (maks GITHUB_MAX_BACKOFF detik)
+        time.sleep(min(GITHUB_FLUSH_INTERVAL * 2 ** failures, GITHUB_MAX_BACKOFF))
+        _GITHUB_DIRTY.clear()
+        failures = 0 if _flush_to_github() else min(failures + 1, 10)
+
+def _flush_github_on_exit():
+    if _GITHUB_DIRTY.is_set() and _RESULTS_READY.is_set():
+        _GITHUB_DIRTY.clear()
+        _flush_to_github()
+
+Thread(target=_github_flusher, name="github-flusher", daemon=True).start()
+atexit.register(_flush_github_on_exit)
+
 # ================= LOAD / SAVE =================
-def save_esp_results():
+# Tiap update ditulis sebagai satu baris di ESP_RESULTS_LOG (append, O(1)),
+# di luar ESP_LOCK dengan _LOG_LOCK sendiri. Urutan dijaga nomor urut "s"
+# yang diambil di dalam ESP_LOCK: saat replay, entri dengan s lebih kecil
+# tidak menimpa yang lebih besar. Tiap SNAPSHOT_INTERVAL detik log dirotasi
+# ke ESP_RESULTS_LOG_OLD (rename, di bawah _LOG_LOCK) lalu snapshot lengkap
+# ditulis. Saat start: snapshot + replay log lama + log.
+_LOG_LOCK = Lock()
+_LOG_SEQ  = count(1)  # dilanjutkan dari nomor terbesar di log saat start
+
+def append_esp_result(esp_id, entry, seq):
+    try:
+        line = json_dumps({"e": esp_id, "c": entry["count"], "t": entry["last_update"], "s": seq})
+        with _LOG_LOCK:
+            with open(ESP_RESULTS_LOG, "ab") as f:
+                f.write(line + b"\n")
+    except Exception as e:
+        print(f"[ERROR] Append log failed: {e}")
+
+_SAVE_LOCK = Lock()  # satu penulis untuk file .tmp bersama
+
+def save_esp_results(snapshot):
+    """Tulis snapshot secara atomik (tmp + rename). Tidak perlu ESP_LOCK."""
     try:
-        with open(ESP_RESULTS_FILE, "w") as f:
-            json.dump(ESP_RESULTS, f, indent=2)
+        tmp_file = ESP_RESULTS_FILE + ".tmp"
+        with _SAVE_LOCK:
+            with open(tmp_file, "wb") as f:
+                f.write(json_dumps(snapshot, indent=True))
+            os.replace(tmp_file, ESP_RESULTS_FILE)
         print("[INFO] Saved esp_results locally")
+        return True
     except Exception as e:
         print(f"[ERROR] Save local failed: {e}")
+        return False
+
+def _replay_log(path, data, seqs):
+    """Replay satu file log ke data; seqs = esp_id -> nomor urut terakhir."""
+    replayed = 0
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                rec = json_loads(line)
+                seq = rec.get("s", 0)
+                if seq < seqs.get(rec["e"], -1):
+                    continue  # update lama yang tertulis belakangan
+                data[rec["e"]] = {"count": rec["c"], "last_update": rec["t"]}
+                seqs[rec["e"]] = seq
+                replayed += 1
+            except Exception:
+                continue  # baris terpotong (crash saat menulis)
+    return replayed
+
+def _snapshot_loop():
+    # Sebelum hydrate GitHub selesai jangan tulis snapshot: kalau proses mati
+    # di tengah jalan, boot berikutnya harus hydrate ulang
+    _RESULTS_READY.wait()
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL)
+        try:
+            with _LOG_LOCK:
+                # Log lama masih ada = snapshot sebelumnya gagal; coba tulis lagi
+                if not os.path.exists(ESP_RESULTS_LOG_OLD):
+                    if not os.path.exists(ESP_RESULTS_LOG) or os.path.getsize(ESP_RESULTS_LOG) == 0:
+                        continue
+                    os.replace(ESP_RESULTS_LOG, ESP_RESULTS_LOG_OLD)
+            # Update selalu masuk dict sebelum di-append, jadi copy setelah
+            # rotasi sudah memuat semua isi log lama
+            with ESP_LOCK:
+                snapshot = dict(ESP_RESULTS)
+            if save_esp_results(snapshot):
+                os.remove(ESP_RESULTS_LOG_OLD)
+        except Exception as e:
+            print(f"[ERROR] Snapshot failed: {e}")
 
-def load_esp_results():
-    global ESP_RESULTS
+def _local_load():
+    """
+    Snapshot + replay log. Return True kalau snapshot ada; log saja belum
+    cukup (bisa berasal dari boot yang hydrate-nya belum selesai).
+    """
+    global ESP_RESULTS, _LOG_SEQ
+    data = None
     if os.path.exists(ESP_RESULTS_FILE):
         try:
-            with open(ESP_RESULTS_FILE, "r") as f:
-                data = json.load(f)
-                if isinstance(data, dict):
-                    ESP_RESULTS = data
+            with open(ESP_RESULTS_FILE, "rb") as f:
+                loaded = json_loads(f.read())
+                if isinstance(loaded, dict):
+                    data = loaded
                     print("[INFO] Loaded esp_results from local file")
-                    return
         except Exception as e:
             print(f"[ERROR] Failed load local: {e}")
+    has_snapshot = data is not None
 
-    try:
-        res = requests.get(
-            f"{GITHUB_API_ROOT}/esp_results.json",
-            headers=GITHUB_HEADERS, timeout=10
-        )
-        if res.status_code == 200:
-            content    = base64.b64decode(res.json()["content"]).decode()
-            data       = json.loads(content)
-            if isinstance(data, dict):
-                ESP_RESULTS = data
-                save_esp_results()
-                print("[INFO] Loaded esp_results from GitHub")
-                return
-    except Exception as e:
-        print(f"[WARN] Failed load from GitHub: {e}")
+    seqs = {}
+    for log_path in (ESP_RESULTS_LOG_OLD, ESP_RESULTS_LOG):
+        if not os.path.exists(log_path):
+            continue
+        try:
+            if data is None:
+                data = {}
+            replayed = _replay_log(log_path, data, seqs)
+            print(f"[INFO] Replayed {replayed} entries from {log_path}")
+        except Exception as e:
+            print(f"[ERROR] Failed replay {log_path}: {e}")
 
-    ESP_RESULTS = {}
-    print("[INFO] ESP_RESULTS initialized empty")
+    _LOG_SEQ    = count(max(seqs.values(), default=0) + 1)
+    ESP_RESULTS = data if data is not None else {}
+    return has_snapshot
+
+def _github_hydrate():
+    """
+    Jalan di background saat belum ada snapshot lokal (disk baru / ephemeral),
+    supaya server tidak menunggu GitHub sebelum bind port. Data GitHub
+    di-merge tanpa menimpa ESP yang sudah upload sejak start. _RESULTS_READY
+    hanya dipasang kalau GitHub menjawab 200 / 404; selain itu dicoba lagi
+    dengan jeda naik eksponensial, supaya flusher tidak menimpa file remote
+    dengan data yang belum lengkap. Entri remote divalidasi (dict dengan
+    count int) sebelum di-merge.
+    """
+    global TOTAL_ALL
+    delay = GITHUB_FLUSH_INTERVAL
+    while True:
+        try:
+            res = GH_SESSION.get(ESP_RESULTS_URL, timeout=GITHUB_READ_TIMEOUT)
+            if res.status_code not in (200, 404):
+                raise Exception(f"status {res.status_code}")
+        except Exception as e:
+            print(f"[WARN] Failed load from GitHub: {e}, retry in {delay}s")
+            time.sleep(delay)
+            delay = min(delay * 2, GITHUB_MAX_BACKOFF)
+            continue
+        break
+
+    remote = {}
+    if res.status_code == 404:
+        print("[INFO] esp_results.json not on GitHub, start empty")
+    else:
+        # Isi rusak tidak dicoba ulang (hasilnya akan sama terus): perlakukan
+        # seperti 404 supaya snapshot & flusher tetap jalan
+        try:
+            data = json_loads(base64.b64decode(res.json()["content"]))
+            if not isinstance(data, dict):
+                raise Exception("bukan object")
+        except Exception as e:
+            print(f"[WARN] esp_results.json di GitHub rusak ({e}), diabaikan")
+            data = {}
+        for esp_id, entry in data.items():
+            if (isinstance(entry, dict) and isinstance(entry.get("count"), int)
+                    and not isinstance(entry["count"], bool)):
+                remote[esp_id] = entry
+            else:
+                print(f"[WARN] Entri GitHub {esp_id!r} tidak valid, dilewati: {str(entry)[:80]}")
+        print(f"[INFO] Loaded {len(remote)} esp_results entries from GitHub")
 
-load_esp_results()
+    with ESP_LOCK:
+        for esp_id, entry in remote.items():
+            ESP_RESULTS.setdefault(esp_id, entry)
+        TOTAL_ALL = sum(v["count"] for v in ESP_RESULTS.values())
+        snapshot  = dict(ESP_RESULTS)
+    save_esp_results(snapshot)
+    _RESULTS_READY.set()
+
+has_snapshot = _local_load()
+# Total semua ESP, diperbarui per delta di /upload (dijaga ESP_LOCK)
+TOTAL_ALL = sum(v["count"] for v in ESP_RESULTS.values())
+if has_snapshot:
+    _RESULTS_READY.set()
+else:
+    print("[INFO] No local snapshot, loading from GitHub in background")
+    Thread(target=_github_hydrate, name="github-hydrate", daemon=True).start()
+Thread(target=_snapshot_loop, name="esp-snapshot", daemon=True).start()
 
 # ================= ROBOFLOW CONFIG =================
 # ⚠️ Tetap pakai konfigurasi asli — JANGAN diubah
@@ -81,9 +451,14 @@ WORKSPACE_NAME = "my-workspace-rrwxa"
 WORKFLOW_ID    = "detect-count-and-visualize"
 TARGET_LABEL   = "female"
 CONF_THRESHOLD = 0.4
+TARGET_LC      = TARGET_LABEL.lower()
 
 rf_client = None
 
+# Session REST fallback, koneksi ke serverless.roboflow.com dipakai ulang
+RF_SESSION = requests.Session()
+RF_SESSION.mount("https://", HTTPAdapter(pool_maxsize=16))
+
 def get_rf_client():
     global rf_client
     if rf_client is None:
@@ -93,11 +468,14 @@ def get_rf_client():
         )
     return rf_client
 
+# Buat client sekali saat start, bukan di request pertama
+get_rf_client()
+
 # ================= ROBOFLOW REST FALLBACK =================
-def run_roboflow_rest(image_bytes):
-    """Fallback: kirim langsung via REST tanpa SDK"""
-    image_b64 = base64.b64encode(image_bytes).decode("utf-8")
-    url       = f"https://serverless.roboflow.com/{WORKSPACE_NAME}/{WORKFLOW_ID}"
+ROBOFLOW_REST_URL = f"https://serverless.roboflow.com/{WORKSPACE_NAME}/{WORKFLOW_ID}"
+
+def run_roboflow_rest(image_b64):
+    """Fallback: kirim langsung via REST tanpa SDK (image sudah base64)"""
     payload   = {
         "api_key": ROBOFLOW_API_KEY,
         "inputs": {
@@ -107,7 +485,7 @@ def run_roboflow_rest(image_bytes):
             }
         }
     }
-    resp = requests.post(url, json=payload, timeout=60)
+    resp = RF_SESSION.post(ROBOFLOW_REST_URL, json=payload, timeout=(3.05, 60))
     print(f"[DEBUG] REST status: {resp.status_code}")
     print(f"[DEBUG] REST response: {resp.text[:500]}")
     if resp.status_code != 200:
@@ -165,6 +543,7 @@ def health():
 # ================= UPLOAD =================
 @app.route("/upload", methods=["POST"])
 def upload():
+    global TOTAL_ALL
     image_data = request.data
     if not image_data:
         return jsonify({"error": "no image data"}), 400
@@ -190,13 +569,9 @@ def upload():
     filename = f"{esp_id}_{timestamp}.jpg"
     print(f"[INFO] Upload dari {esp_id} | size: {image_size} bytes")
 
-    # Simpan ke disk
-    try:
-        with open(filename, "wb") as f:
-            f.write(image_data)
-        print(f"[INFO] Saved: {filename}")
-    except Exception as e:
-        return jsonify({"error": "save image failed", "detail": str(e)}), 500
+    # Encode sekali, dipakai SDK (string base64 diteruskan apa adanya, tanpa
+    # decode / re-encode JPEG), REST fallback, dan upload GitHub
+    image_b64 = base64.b64encode(image_data).decode()
 
     # ===== ROBOFLOW: SDK dulu, fallback REST =====
     result      = None
@@ -207,120 +582,83 @@ def upload():
         result = rf.run_workflow(
             workspace_name=WORKSPACE_NAME,
             workflow_id=WORKFLOW_ID,
-            images={"image": filename},
+            images={"image": image_b64},
             use_cache=False
         )
         method_used = "SDK"
         print("[INFO] Roboflow SDK berhasil")
         try:
-            print("[DEBUG] SDK result:\n" + json.dumps(result, indent=2, default=str))
+            print("[DEBUG] SDK result:\n" + json_dumps(result, indent=True, default=str).decode())
         except Exception:
             print("[DEBUG] SDK result:", str(result)[:500])
 
     except Exception as sdk_err:
         print(f"[WARN] SDK gagal: {sdk_err} — mencoba REST...")
         try:
-            result      = run_roboflow_rest(image_data)
+            result      = run_roboflow_rest(image_b64)
             method_used = "REST"
             print("[INFO] REST berhasil")
         except Exception as rest_err:
             print(f"[ERROR] REST juga gagal: {rest_err}")
-            if os.path.exists(filename):
-                os.remove(filename)
             return jsonify({
                 "error":      "roboflow failed",
                 "sdk_error":  str(sdk_err),
                 "rest_error": str(rest_err)
             }), 500
 
-    # ===== UPLOAD GAMBAR KE GITHUB =====
-    github_success = False
-    try:
-        with open(filename, "rb") as f:
-            img_b64 = base64.b64encode(f.read()).decode()
-
-        folder_path = f"{GITHUB_FOLDER}/esp_{esp_id.split('_')[-1] if '_' in esp_id else esp_id}"
-        put_url     = f"{GITHUB_API_ROOT}/{folder_path}/{filename}"
-
-        get_res = requests.get(put_url, headers=GITHUB_HEADERS, timeout=5)
-        sha     = get_res.json().get("sha") if get_res.status_code == 200 else None
-
-        payload = {
-            "message": f"upload from {esp_id} ({filename})",
-            "content": img_b64
-        }
-        if sha:
-            payload["sha"] = sha
-
-        res = requests.put(put_url, headers=GITHUB_HEADERS, json=payload, timeout=15)
-        if res.status_code in (200, 201):
-            github_success = True
-            print(f"[INFO] GitHub image: {res.status_code}")
-        else:
-            print(f"[WARN] GitHub image failed: {res.status_code} - {res.text}")
-    except Exception as e:
-        print(f"[WARN] GitHub image error: {e}")
-
-    if os.path.exists(filename):
-        os.remove(filename)
-
     # ===== PARSE PREDICTIONS =====
     predictions_list = parse_predictions(result)
 
     print(f"[DEBUG] method={method_used}, total predictions={len(predictions_list)}")
     for p in predictions_list:
+        if not isinstance(p, dict):
+            print(f"   → (skip, bukan dict: {str(p)[:80]})")
+            continue
         lbl  = p.get("class") or p.get("label") or "unknown"
         conf = float(p.get("confidence") or p.get("score") or 0.0)
         print(f"   → '{lbl}' ({conf*100:.1f}%)")
 
-    # Filter target
-    filtered = []
-    for p in predictions_list:
-        label = p.get("class") or p.get("label") or "unknown"
-        conf  = float(p.get("confidence") or p.get("score") or 0.0)
-        if label.lower() == TARGET_LABEL.lower() and conf >= CONF_THRESHOLD:
-            filtered.append({
-                "label":      label,
-                "confidence": round(conf * 100, 2)
-            })
+    # Filter target (cek confidence & label persis dulu, .lower() hanya kalau perlu)
+    filtered = [
+        {"label": label, "confidence": round(conf * 100, 2)}
+        for p in predictions_list if isinstance(p, dict)
+        for label in (p.get("class") or p.get("label"),) if label
+        for conf in (float(p.get("confidence") or p.get("score") or 0.0),)
+        if conf >= CONF_THRESHOLD and (label == TARGET_LABEL or label.lower() == TARGET_LC)
+    ]
 
     detected_count = len(filtered)
     print(f"[INFO] '{TARGET_LABEL}' terdeteksi: {detected_count}")
 
+    # ===== UPLOAD GAMBAR KE GITHUB (antre, ikut commit berikutnya) =====
+    # Frame kosong cuma diambil 1 dari IMAGE_SAMPLE_EVERY (per ESP)
+    image_queued = (detected_count > 0
+                    or next(_EMPTY_FRAMES.setdefault(esp_id, count())) % IMAGE_SAMPLE_EVERY == 0)
+    if image_queued:
+        @after_this_request
+        def _queue_image_after_response(response):
+            # call_on_close jalan setelah server selesai mengirim respons ke ESP,
+            # jadi antre gambar tidak menambah latency ke client
+            response.call_on_close(lambda: queue_image(esp_id, filename, image_b64))
+            return response
+    else:
+        print(f"[INFO] Skip GitHub image {filename} (0 terdeteksi)")
+
     # ===== UPDATE & SAVE =====
+    entry = {
+        "count":       detected_count,
+        "last_update": timestamp * 1000
+    }
     with ESP_LOCK:
-        ESP_RESULTS[esp_id] = {
-            "count":       detected_count,
-            "last_update": timestamp * 1000
-        }
-        save_esp_results()
+        prev       = ESP_RESULTS.get(esp_id, {}).get("count", 0)
+        ESP_RESULTS[esp_id] = entry
+        TOTAL_ALL += detected_count - prev
+        total_all  = TOTAL_ALL
+        snapshot   = dict(ESP_RESULTS)
+        seq        = next(_LOG_SEQ)
+    append_esp_result(esp_id, entry, seq)
 
-        try:
-            json_content = json.dumps(ESP_RESULTS, indent=2).encode()
-            content_b64  = base64.b64encode(json_content).decode()
-
-            get_res = requests.get(
-                f"{GITHUB_API_ROOT}/esp_results.json",
-                headers=GITHUB_HEADERS, timeout=10
-            )
-            sha = get_res.json().get("sha") if get_res.status_code == 200 else None
-
-            put_data = {
-                "message": f"Update from {esp_id} - {time.strftime('%Y-%m-%d %H:%M')}",
-                "content": content_b64
-            }
-            if sha:
-                put_data["sha"] = sha
-
-            put_res = requests.put(
-                f"{GITHUB_API_ROOT}/esp_results.json",
-                headers=GITHUB_HEADERS, json=put_data, timeout=15
-            )
-            print(f"[INFO] GitHub JSON: {put_res.status_code}")
-        except Exception as e:
-            print(f"[WARN] GitHub JSON error: {e}")
-
-    total_all = sum(v["count"] for v in ESP_RESULTS.values())
+    _GITHUB_DIRTY.set()
 
     return jsonify({
         "status":               "ok",
@@ -329,19 +667,25 @@ def upload():
         "image_size_bytes":     image_size,
         "detected_this_esp":    detected_count,
         "total_all_esp":        total_all,
-        "per_esp":              ESP_RESULTS,
+        "per_esp":              snapshot,
         "objects":              filtered,
-        "github_image_success": github_success
+        "github_image_queued":  image_queued,
+        # Dipertahankan untuk firmware lama. Upload ke GitHub sekarang jalan
+        # di background, jadi nilainya sama dengan github_image_queued
+        # (gambar masuk antrean), bukan konfirmasi dari GitHub.
+        "github_image_success": image_queued
     })
 
 # ================= SUMMARY =================
 @app.route("/summary", methods=["GET"])
 def summary():
     with ESP_LOCK:
-        return jsonify({
-            "total_all_esp": sum(v["count"] for v in ESP_RESULTS.values()),
-            "per_esp":       ESP_RESULTS
-        })
+        total_all = TOTAL_ALL
+        snapshot  = dict(ESP_RESULTS)
+    return jsonify({
+        "total_all_esp": total_all,
+        "per_esp":       snapshot
+    })
 
 # ================= RUN =================
 if __name__ == "__main__":
@@ -0,0 +1,10 @@
+# Dibaca otomatis oleh `gunicorn app:app` dari direktori kerja.
+import os
+
+bind         = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+# ESP_RESULTS, TOTAL_ALL, log, dan flusher GitHub hidup di memori proses,
+# jadi cukup 1 worker; konkurensi datang dari thread.
+workers      = 1
+worker_class = "gthread"
+threads      = int(os.environ.get("GUNICORN_THREADS", 16))
+timeout      = 60